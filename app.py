@@ -1,35 +1,127 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Response
+from fastapi.responses import JSONResponse
 import httpx
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional, Tuple
+from collections import defaultdict
+from contextlib import asynccontextmanager
 import libtorrent as lt
 import psutil
 import os
-import json
-
-app = FastAPI(title="BitTorrent Manager")
-
-# Configuration et gestion de la session libtorrent
-session_params = lt.session_params()
-session_params.settings = {'listen_interfaces': '0.0.0.0:6881'}
-session = lt.session(session_params)
-
-# Structures de données pour stocker les torrents et webhooks
-torrents = {}
-webhooks = []
+import asyncio
+import hashlib
+import mmap
+import shutil
+import sqlite3
+import ssl
+import tempfile
+import threading
+import msgspec
+
+class MsgspecJSONResponse(JSONResponse):
+    # Encodage JSON en C via msgspec plutôt que json.dumps de la bibliothèque standard
+    def render(self, content) -> bytes:
+        return msgspec.json.encode(content)
 
 # Répertoires pour la sauvegarde et les téléchargements
 bitserve_dir = "./.bitserve"
 state_file_path = os.path.join(bitserve_dir, "session_state.dat")
-torrents_file_path = os.path.join(bitserve_dir, "torrents_data.json")
+torrents_db_path = os.path.join(bitserve_dir, "torrents.db")
+legacy_torrents_file_path = os.path.join(bitserve_dir, "torrents_data.json")
 downloads_path = "./downloads"
 torrent_files_dir = os.path.join(bitserve_dir, "torrent_files")
 
+# Nombre maximal de pairs mémorisés par torrent pour accélérer le redémarrage
+max_cached_peers = 200
+
+# Champs optionnels demandés à libtorrent pour les statuts : le nom est déjà connu de l'application,
+# seuls les compteurs de téléchargement exacts sont nécessaires
+status_query_flags = lt.status_flags_t.query_accurate_download_counters
+
+# Intervalle (secondes) des sauvegardes périodiques : un arrêt brutal ne perd qu'au plus un intervalle
+state_flush_interval = 30
+
 # S'assurer que les répertoires nécessaires existent
 os.makedirs(bitserve_dir, exist_ok=True)
 os.makedirs(downloads_path, exist_ok=True)
 os.makedirs(torrent_files_dir, exist_ok=True)
 
+# Configuration et gestion de la session libtorrent
+def load_session_params():
+    # L'état sauvegardé (DHT, réglages) est relu avant la création de la session
+    try:
+        with open(state_file_path, "rb") as f:
+            params = lt.read_session_params(f.read())
+        print("Session state restored.")
+    except FileNotFoundError:
+        params = lt.session_params()
+    except RuntimeError as e:
+        # Fichier illisible (tronqué, corrompu) : la session repart de zéro plutôt que de bloquer le démarrage
+        print(f"Session state ignored: {e}")
+        params = lt.session_params()
+    settings = params.settings
+    # Préréglage libtorrent pour le seed à fort débit : files d'attente, tampons d'envoi, limites de connexions
+    settings.update(lt.high_performance_seed())
+    settings.update({
+        'listen_interfaces': '0.0.0.0:6881',
+        # Uniquement les alertes consommées par l'application : statuts, resume data et erreurs
+        'alert_mask': lt.alert_category.status | lt.alert_category.storage | lt.alert_category.error,
+    })
+    params.settings = settings
+    return params
+
+session_params = load_session_params()
+session = lt.session(session_params)
+
+# libtorrent écrit dans ce tube dès qu'une alerte arrive : la boucle asyncio n'est réveillée qu'à ce moment
+alert_read_fd, alert_write_fd = os.pipe()
+os.set_blocking(alert_read_fd, False)
+os.set_blocking(alert_write_fd, False)
+session.set_alert_fd(alert_write_fd)
+
+# Structures de données pour stocker les torrents et webhooks
+torrents = {}
+# Webhooks indexés par événement puis par URL : {événement: {url: format}}
+webhooks_by_event = defaultdict(dict)
+# Verrou unique pour `torrents` et les caches de statut, modifiés depuis la boucle et les threads
+torrents_lock = threading.Lock()
+
+# Cache des statuts libtorrent, alimenté par les state_update_alert
+torrent_status_cache = {}
+# Lignes de /torrents/ précalculées à chaque mise à jour de statut, formatées et brutes
+torrent_rows = {}
+raw_torrent_rows = {}
+
+# Torrents restaurés via async_add_torrent, en attente de leur add_torrent_alert
+pending_restores = {}
+# Torrents supprimés pendant leur restauration : options de remove_torrent à appliquer à leur add_torrent_alert
+pending_removals = {}
+# info_hash des envois en cours d'ajout à la session : réservés avant l'ajout libtorrent, fait hors du verrou
+pending_uploads = set()
+
+# Dernière version écrite en base de chaque torrent : seules les lignes modifiées sont réécrites
+persisted_recs = {}
+
+# SHA-1 des fichiers .torrent déjà ajoutés, pour écarter les renvois identiques sans décodage
+known_file_sha1 = set()
+
+# Encodeur msgpack réutilisé pour toutes les charges utiles de webhooks
+webhook_encoder = msgspec.msgpack.Encoder()
+
+# Instantané de /system-info/ déjà encodé en JSON, renouvelé en tâche de fond
+system_info_cache = {"data": None}
+# Intervalle (secondes) entre deux échantillons psutil
+system_info_interval = 1
+
+# Champs de /system-info/ exprimés en gigaoctets, dans l'ordre des valeurs mesurées
+SYSINFO_GB_KEYS = (
+    "disk_total_gb", "disk_used_gb", "disk_free_gb",
+    "memory_total_gb", "memory_available_gb", "memory_used_gb", "memory_free_gb",
+)
+# Diviseur et formatage partagés par tous ces champs
+GB = 1 << 30
+format_gb = "{:.2f} Go".format
+
 # Modèles Pydantic pour la validation des données
 class Webhook(BaseModel):
     event: str
@@ -39,189 +131,699 @@ class TorrentRemovalRequest(BaseModel):
     info_hashes: List[str]
     remove_files: Optional[bool] = False
 
+# Schéma msgspec d'un torrent persisté
+class TorrentRec(msgspec.Struct):
+    info_hash: str
+    name: str
+    total_uploaded: int
+    total_downloaded: int
+    peers: List[Tuple[str, int]] = []
+    file_sha1: str = ""
+
+# Encodeur/décodeur réutilisés pour la colonne `peers`
+peers_encoder = msgspec.msgpack.Encoder()
+peers_decoder = msgspec.msgpack.Decoder(List[Tuple[str, int]])
+
 # Fonctions de gestion des torrents et de la session
-def save_session_state():
-    with open(state_file_path, "wb") as f:
-        f.write(lt.bencode(session.save_state()))
-    print("Session state saved.")
+def write_file_atomically(path, data):
+    # Écrit dans un fichier temporaire du même répertoire puis le substitue : un arrêt brutal
+    # laisse l'ancienne version intacte, jamais un fichier vide ou tronqué
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        os.fchmod(fd, 0o644)
+        with open(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
-def load_session_state():
-    if os.path.exists(state_file_path):
-        with open(state_file_path, "rb") as f:
-            session.load_state(lt.bdecode(f.read()))
-        print("Session state restored.")
+def save_session_state():
+    # Bencode produit directement en C++, sans dict Python intermédiaire
+    write_file_atomically(state_file_path, lt.write_session_params_buf(session.session_state()))
 
 def save_torrents_data():
-    for info_hash, torrent in torrents.items():
-        torrent_status = torrent['handle'].status()
+    recs = []
+    rows = {}
+    with torrents_lock:
+        snapshot = [(info_hash, torrent, torrent_status_cache[info_hash]) for info_hash, torrent in torrents.items()]
+
+    for info_hash, torrent, torrent_status in snapshot:
         # Mise à jour des valeurs avec les données actuelles
         torrent['total_uploaded'] = torrent_status.total_upload
         torrent['total_downloaded'] = torrent_status.total_done
+        # Le ratio affiché dépend des totaux qui viennent d'être mis à jour
+        rows[info_hash] = (torrent_status, *build_torrent_rows(info_hash, torrent_status, torrent))
+        # Les seeders en premier : ce sont eux qu'on veut retrouver au redémarrage. Ordre stable
+        # (par ip) pour que la détection des changements ne voie pas un simple réordonnancement
+        try:
+            peer_infos = sorted(torrent['handle'].get_peer_info(), key=lambda p: (not p.flags & lt.peer_info.seed, p.ip))
+        except RuntimeError:
+            # Torrent retiré depuis l'instantané : son entrée serait de toute façon écartée ci-dessous
+            continue
+        recs.append(TorrentRec(
+            info_hash=info_hash,
+            name=torrent['name'],
+            total_uploaded=torrent['total_uploaded'],
+            total_downloaded=torrent['total_downloaded'],
+            peers=[tuple(p.ip) for p in peer_infos[:max_cached_peers]],
+            file_sha1=torrent['file_sha1'],
+        ))
+
+    with torrents_lock:
+        # Réconcilie avec les ajouts/suppressions survenus pendant la collecte
+        recs = [rec for rec in recs if rec.info_hash in torrents]
+        collected = {rec.info_hash for rec in recs}
+        recs.extend(
+            TorrentRec(
+                info_hash=info_hash,
+                name=torrent['name'],
+                total_uploaded=torrent['total_uploaded'],
+                total_downloaded=torrent['total_downloaded'],
+                file_sha1=torrent['file_sha1'],
+            ) for info_hash, torrent in torrents.items() if info_hash not in collected
+        )
+        # Les torrents encore en cours de restauration gardent leur entrée telle quelle
+        recs.extend(pending_restores.values())
+        changed = [rec for rec in recs if persisted_recs.get(rec.info_hash) != rec]
+        queue_db_upsert(changed)
+        persisted_recs.update((rec.info_hash, rec) for rec in changed)
+        # Lignes construites hors du verrou : posées seulement si aucun statut plus récent n'est arrivé entre-temps
+        for info_hash, (torrent_status, row, raw_row) in rows.items():
+            if torrent_status_cache.get(info_hash) is torrent_status:
+                torrent_rows[info_hash] = row
+                raw_torrent_rows[info_hash] = raw_row
+    flush_db_writes()
+
+# Base SQLite des torrents : une ligne par torrent, mise à jour individuellement
+# Connexion unique pour tout le processus, partagée par les threads du pool
+db_conn = sqlite3.connect(torrents_db_path, check_same_thread=False)
+# Une connexion ne supporte qu'une transaction à la fois : toute utilisation de `db_conn` passe par ce verrou
+db_lock = threading.Lock()
+
+# WAL : les lectures ne bloquent plus les écritures ; synchronous=NORMAL suffit en WAL
+# pour ne perdre au pire que la dernière transaction, sans fsync à chaque commit
+db_pragmas = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",
+    "busy_timeout=5000",
+    # Points de contrôle WAL moins fréquents (en pages) : moins de réécritures du fichier principal
+    "wal_autocheckpoint=10000",
+)
+
+def init_db():
+    with db_lock:
+        for pragma in db_pragmas:
+            db_conn.execute(f"PRAGMA {pragma}")
+        with db_conn:
+            db_conn.execute(
+                "CREATE TABLE IF NOT EXISTS torrents ("
+                "info_hash TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                "total_uploaded INTEGER NOT NULL, total_downloaded INTEGER NOT NULL, "
+                "peers BLOB NOT NULL, file_sha1 TEXT NOT NULL)"
+            )
+
+# Écritures en attente, dans l'ordre décidé sous `torrents_lock` : ("put", recs) ou ("del", info_hashes).
+# Elles sont appliquées hors de ce verrou, que la boucle d'événements prend, pour ne jamais l'exposer à SQLite
+db_pending_writes = []
+
+def queue_db_upsert(recs):
+    # Appelé sous `torrents_lock`, suivi de flush_db_writes une fois le verrou relâché
+    if recs:
+        db_pending_writes.append(("put", recs))
+
+def queue_db_delete(info_hashes):
+    # Appelé sous `torrents_lock`, suivi de flush_db_writes une fois le verrou relâché
+    if info_hashes:
+        db_pending_writes.append(("del", info_hashes))
+
+def flush_db_writes():
+    # Appelé hors de `torrents_lock`. `db_lock` est pris avant de relever la file : deux vidages
+    # concurrents appliquent leurs lots dans l'ordre de la file, en une transaction chacun
+    with db_lock:
+        with torrents_lock:
+            writes = db_pending_writes[:]
+            db_pending_writes.clear()
+        if not writes:
+            return
+        with db_conn:
+            for kind, items in writes:
+                if kind == "put":
+                    db_conn.executemany("INSERT OR REPLACE INTO torrents VALUES (?, ?, ?, ?, ?, ?)", [
+                        (rec.info_hash, rec.name, rec.total_uploaded, rec.total_downloaded, peers_encoder.encode(rec.peers), rec.file_sha1)
+                        for rec in items
+                    ])
+                else:
+                    db_conn.executemany("DELETE FROM torrents WHERE info_hash = ?", [(info_hash,) for info_hash in items])
+
+def db_read_torrents():
+    # Les lignes sont consommées directement depuis le curseur, sans liste intermédiaire de tuples ;
+    # le décodeur typé renvoie déjà les pairs sous forme de tuples
+    with db_lock:
+        return [
+            TorrentRec(
+                info_hash=info_hash,
+                name=name,
+                total_uploaded=total_uploaded,
+                total_downloaded=total_downloaded,
+                peers=peers_decoder.decode(peers),
+                file_sha1=file_sha1,
+            ) for info_hash, name, total_uploaded, total_downloaded, peers, file_sha1 in db_conn.execute(
+                "SELECT info_hash, name, total_uploaded, total_downloaded, peers, file_sha1 FROM torrents"
+            )
+        ]
 
-    data_to_save = {
-        info_hash: {
-            "info_hash": info_hash,
-            "name": torrent['handle'].status().name,
-            "total_uploaded": torrent['total_uploaded'],
-            "total_downloaded": torrent['total_downloaded'],
-        } for info_hash, torrent in torrents.items()
-    }
-    with open(torrents_file_path, "w") as f:
-        json.dump(data_to_save, f)
 
+def write_resume_files(resume_buffers):
+    # resume_buffers : (info_hash, resume data bencodées) produits par les save_resume_data_alert
+    for info_hash, buf in resume_buffers:
+        write_file_atomically(os.path.join(torrent_files_dir, f"{info_hash}.resume"), buf)
+
+def request_resume_data_checkpoint():
+    # Asynchrone : libtorrent publie un save_resume_data_alert, traité par drain_alerts,
+    # uniquement pour les torrents modifiés depuis la dernière sauvegarde
+    with torrents_lock:
+        handles = [torrent['handle'] for torrent in torrents.values()]
+    for handle in handles:
+        try:
+            handle.save_resume_data(lt.torrent_handle.only_if_modified)
+        except RuntimeError:
+            # Torrent retiré depuis l'instantané : handle invalide, rien à sauvegarder
+            pass
+
+def save_resume_data():
+    # Écrit les resume data de chaque torrent pour éviter la revérification au redémarrage
+    with torrents_lock:
+        handles = [torrent['handle'] for torrent in torrents.values()]
+    # Suivi par info_hash : une alerte d'un point de sauvegarde périodique encore en vol ne fausse pas le compte
+    outstanding = set()
+    for handle in handles:
+        try:
+            handle.save_resume_data()
+        except RuntimeError:
+            # Torrent retiré depuis l'instantané : aucune alerte à attendre
+            continue
+        outstanding.add(str(handle.info_hash()))
+
+    while outstanding:
+        if session.wait_for_alert(10000) is None:
+            print("Timed out waiting for resume data.")
+            break
+        for alert in session.pop_alerts():
+            if isinstance(alert, lt.save_resume_data_alert):
+                info_hash = str(alert.handle.info_hash())
+                outstanding.discard(info_hash)
+                write_resume_files([(info_hash, lt.write_resume_data_buf(alert.params))])
+            elif isinstance(alert, lt.save_resume_data_failed_alert):
+                outstanding.discard(str(alert.handle.info_hash()))
+    print("Resume data saved.")
+
+def read_legacy_torrents_data():
+    # Fichier JSON d'origine
+    with open(legacy_torrents_file_path, "rb") as f:
+        loaded_torrents = msgspec.json.decode(f.read())
+    return [
+        TorrentRec(
+            info_hash=info_hash,
+            name=torrent_data.get('name', "Unknown"),
+            total_uploaded=torrent_data.get('total_uploaded', 0),
+            total_downloaded=torrent_data.get('total_downloaded', 0),
+        ) for info_hash, torrent_data in loaded_torrents.items()
+    ]
+
+def read_torrents_data():
+    # Lit la base des torrents, en y migrant une seule fois l'ancien fichier JSON
+    if os.path.exists(legacy_torrents_file_path):
+        with torrents_lock:
+            queue_db_upsert(read_legacy_torrents_data())
+        flush_db_writes()
+        os.remove(legacy_torrents_file_path)
+        print("Legacy torrents data migrated to SQLite.")
+    return db_read_torrents()
 
 def load_torrents_data():
-    # Charge les données des torrents et recrée la structure `torrents`
-    if os.path.exists(torrents_file_path):
-        with open(torrents_file_path) as f:
-            loaded_torrents = json.load(f)
-        
-        for info_hash, torrent_data in loaded_torrents.items():
-            add_torrent_from_file(
-                file_path=os.path.join(torrent_files_dir, f"{info_hash}.torrent"),
-                info_hash=info_hash,
-                total_uploaded=torrent_data.get('total_uploaded', 0),
-                total_downloaded=torrent_data.get('total_downloaded', 0),
-                name=torrent_data.get('name', "Unknown")
-            )
+    # Charge les données des torrents : les ajouts sont pipelinés par async_add_torrent
+    # et `torrents` est complété à la réception de chaque add_torrent_alert
+    for rec in read_torrents_data():
+        file_path = os.path.join(torrent_files_dir, f"{rec.info_hash}.torrent")
+        up_to_date = bool(rec.file_sha1)
+        if not up_to_date:
+            # Entrée antérieure à l'empreinte : le .torrent conservé est le fichier envoyé tel quel ;
+            # la ligne sera complétée à la prochaine sauvegarde
+            rec.file_sha1 = read_file_sha1(file_path)
+        with torrents_lock:
+            pending_restores[rec.info_hash] = rec
+            known_file_sha1.add(rec.file_sha1)
+            if up_to_date:
+                persisted_recs[rec.info_hash] = rec
+        add_torrent_from_file(file_path, rec.info_hash)
     print("Torrents data loaded.")
 
-def add_torrent_from_file(file_path, info_hash, total_uploaded=0, total_downloaded=0, name="Unknown"):
-    # Ajoute un torrent à partir d'un fichier et initialise les données
-    with open(file_path, 'rb') as f:
-        e = lt.bdecode(f.read())
-        info = lt.torrent_info(e)
-        params = {
-            'ti': info,
-            'save_path': downloads_path,
-        }
-        handle = session.add_torrent(params)
-        torrents[info_hash] = {
-            'handle': handle,
-            # Utilise les valeurs fournies pour initialiser les totaux
-            'total_uploaded': total_uploaded,
-            'total_downloaded': total_downloaded,
-            'name': name,
-        }
-
-# Gestion des événements de l'application
-@app.on_event("startup")
-async def startup_event():
-    load_session_state()
-    load_torrents_data()
-
-@app.on_event("shutdown")
-def shutdown_event():
-    save_session_state()
-    save_torrents_data()
+def add_torrent_from_file(file_path, info_hash):
+    # libtorrent lit et décode le fichier en C++, sans bdecode côté Python
+    session.async_add_torrent(build_add_torrent_params(lt.torrent_info(file_path), info_hash))
+
+def build_add_torrent_params(info, info_hash):
+    # Les resume data évitent la revérification complète des pièces sur disque
+    resume_file_path = os.path.join(torrent_files_dir, f"{info_hash}.resume")
+    params = None
+    if os.path.exists(resume_file_path):
+        with open(resume_file_path, 'rb') as resume_file:
+            try:
+                params = lt.read_resume_data(resume_file.read())
+            except RuntimeError as e:
+                # Resume data illisibles : le torrent est simplement revérifié
+                print(f"Resume data for {info_hash} ignored: {e}")
+    if params is None:
+        params = lt.add_torrent_params()
+    params.ti = info
+    params.save_path = downloads_path
+    return params
+
+def add_torrent(info, info_hash, name="Unknown", file_sha1=""):
+    # Ajoute un torrent déjà décodé à la session ; appelé hors de `torrents_lock`,
+    # l'ajout et le premier statut étant des allers-retours synchrones avec libtorrent
+    handle = session.add_torrent(build_add_torrent_params(info, info_hash))
+    status = handle.status(status_query_flags)
+    with torrents_lock:
+        register_torrent(info_hash, handle, status, name=name, file_sha1=file_sha1)
+        known_file_sha1.add(file_sha1)
+
+def register_torrent(info_hash, handle, status, total_uploaded=0, total_downloaded=0, name="Unknown", peers=(), file_sha1=""):
+    # Appelé sous `torrents_lock` une fois le handle et son premier statut obtenus
+    # Reconnecte directement les pairs connus sans attendre tracker/DHT
+    for peer in peers:
+        handle.connect_peer(peer)
+    torrents[info_hash] = {
+        'handle': handle,
+        # Utilise les valeurs fournies pour initialiser les totaux
+        'total_uploaded': total_uploaded,
+        'total_downloaded': total_downloaded,
+        'name': name,
+        'file_sha1': file_sha1,
+    }
+    cache_torrent_status(info_hash, status, torrents[info_hash])
+
+def cache_torrent_status(info_hash, status, torrent):
+    # Appelé sous `torrents_lock` : met à jour le statut et les deux lignes de /torrents/
+    torrent_status_cache[info_hash] = status
+    torrent_rows[info_hash], raw_torrent_rows[info_hash] = build_torrent_rows(info_hash, status, torrent)
+
+def build_torrent_rows(info_hash, status, torrent):
+    # Lignes formatée et brute de /torrents/ pour un statut donné
+    ratio = (torrent['total_uploaded'] / torrent['total_downloaded']) if torrent['total_downloaded'] > 0 else 0
+    row = {
+        "info_hash": info_hash,
+        "name": torrent['name'],
+        "progress": status.progress * 100,
+        "download_rate": status.download_rate / 1000,
+        "upload_rate": status.upload_rate / 1000,
+        "status": str(status.state),
+        "seedtime_hours": status.seeding_time / 3600,
+        "num_peers": status.num_peers,
+        "ratio": f"{ratio:.6f}"
+    }
+    # Valeurs brutes (fraction, octets/s, secondes) : aucune conversion côté serveur
+    raw_row = {
+        "info_hash": info_hash,
+        "name": torrent['name'],
+        "progress": status.progress,
+        "download_rate": status.download_rate,
+        "upload_rate": status.upload_rate,
+        "status": str(status.state),
+        "seedtime": status.seeding_time,
+        "num_peers": status.num_peers,
+        "ratio": ratio
+    }
+    return row, raw_row
+
+def finish_restore(alert, status):
+    # Appelé sous `torrents_lock` à la réception d'un add_torrent_alert, avec le statut demandé hors du verrou
+    info_hash = str(alert.params.ti.info_hash())
+    if info_hash in torrents or info_hash in pending_uploads:
+        # Ajout synchrone d'un envoi, enregistré par add_torrent
+        return
+    rec = pending_restores.pop(info_hash, None)
+    remove_flags = pending_removals.pop(info_hash, 0)
+    if alert.error.value():
+        print(f"Failed to restore torrent {info_hash}: {alert.message()}")
+        if rec is not None:
+            known_file_sha1.discard(rec.file_sha1)
+        return
+    if rec is None:
+        # Supprimé pendant la restauration : retiré avec les options demandées (fichiers compris)
+        session.remove_torrent(alert.handle, remove_flags)
+        return
+    register_torrent(info_hash, alert.handle, status, rec.total_uploaded, rec.total_downloaded, rec.name, rec.peers, rec.file_sha1)
+
+def drain_alerts():
+    # Finalise les restaurations, écrit les points de reprise puis met à jour le cache avec les statuts groupés
+    updates = {}
+    added = []
+    resume_buffers = []
+    for alert in session.pop_alerts():
+        if isinstance(alert, lt.state_update_alert):
+            updates.update((str(torrent_status.info_hash), torrent_status) for torrent_status in alert.status)
+        elif isinstance(alert, lt.add_torrent_alert):
+            added.append(alert)
+        elif isinstance(alert, lt.save_resume_data_alert):
+            resume_buffers.append((str(alert.handle.info_hash()), lt.write_resume_data_buf(alert.params)))
+    if not (updates or added or resume_buffers):
+        return
+
+    # Premier statut des torrents ajoutés : aller-retour libtorrent fait avant de prendre le verrou
+    restored = []
+    for alert in added:
+        try:
+            status = None if alert.error.value() else alert.handle.status(status_query_flags)
+        except RuntimeError:
+            # Handle déjà invalide : torrent retiré entre-temps
+            status = None
+        restored.append((alert, status))
+
+    with torrents_lock:
+        for alert, status in restored:
+            finish_restore(alert, status)
+        # Pas de .resume pour un torrent supprimé entre-temps
+        resume_buffers = [(info_hash, buf) for info_hash, buf in resume_buffers if info_hash in torrents]
+        for info_hash, torrent_status in updates.items():
+            # Ignore les statuts des torrents supprimés entre-temps
+            torrent = torrents.get(info_hash)
+            if torrent is not None:
+                cache_torrent_status(info_hash, torrent_status, torrent)
+    if resume_buffers:
+        # Écriture des fichiers .resume dans le pool de threads, hors de la boucle
+        asyncio.get_running_loop().run_in_executor(None, write_resume_files, resume_buffers)
+
+def on_alerts_ready():
+    # Vide le tube de notification puis consomme les alertes en attente
+    try:
+        os.read(alert_read_fd, 4096)
+    except BlockingIOError:
+        pass
+    drain_alerts()
+
+async def flush_state_periodically(stop: asyncio.Event):
+    # Points de sauvegarde réguliers : l'arrêt n'a plus qu'à compléter le dernier intervalle.
+    # La boucle s'arrête sur `stop` et jamais au milieu d'une sauvegarde : une annulation
+    # n'interromprait pas le thread, qui continuerait d'écrire pendant les sauvegardes finales
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), state_flush_interval)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            request_resume_data_checkpoint()
+            await asyncio.to_thread(save_torrents_data)
+            await asyncio.to_thread(save_session_state)
+        except Exception as e:
+            # Un point de sauvegarde raté n'arrête pas les suivants
+            print(f"Periodic state flush failed: {e}")
+
+async def sample_system_info():
+    # Échantillonnage régulier hors requête ; cpu_percent mesure ainsi l'utilisation sur l'intervalle
+    while True:
+        await asyncio.sleep(system_info_interval)
+        system_info_cache["data"] = await asyncio.to_thread(compute_system_info)
+
+async def request_status_updates():
+    # Demande un state_update_alert par seconde au lieu d'un status() par torrent et par requête ;
+    # l'alerte est consommée par on_alerts_ready dès que libtorrent la publie
+    while True:
+        session.post_torrent_updates(status_query_flags)
+        await asyncio.sleep(1)
+
+def stream_upload_to_fd(upload, dst_fd):
+    # Copie noyau→noyau via sendfile quand l'envoi a déjà été écrit sur disque
+    src = upload.file
+    if hasattr(os, "sendfile") and getattr(src, "_rolled", True):
+        src_fd = src.fileno()
+        while os.sendfile(dst_fd, src_fd, None, 1 << 20):
+            pass
+    else:
+        # Petits envois gardés en mémoire par SpooledTemporaryFile, ou plateforme sans sendfile
+        with open(dst_fd, "wb", closefd=False) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+# Cycle de vie de l'application : ressources ouvertes au démarrage et libérées dans l'ordre inverse
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Les empreintes d'info_hash passent par OpenSSL (SHA-NI / extensions ARMv8 si le CPU les propose)
+    print(f"Info-hash digests computed with {ssl.OPENSSL_VERSION}.")
+    loop = asyncio.get_running_loop()
+    # Le lecteur d'alertes doit être en place pour recevoir les add_torrent_alert de la restauration
+    loop.add_reader(alert_read_fd, on_alerts_ready)
+    # Ouverture de la base, lecture des torrents et décodage des .torrent hors de la boucle d'événements
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(load_torrents_data)
+    # Premier instantané pris avant de servir les requêtes
+    system_info_cache["data"] = await asyncio.to_thread(compute_system_info)
+    periodic_tasks = [
+        asyncio.create_task(request_status_updates()),
+        asyncio.create_task(sample_system_info()),
+    ]
+    flush_stop = asyncio.Event()
+    flush_task = asyncio.create_task(flush_state_periodically(flush_stop))
+    # Client HTTP partagé : connexions keep-alive/HTTP/2 réutilisées entre webhooks
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        # Plafond explicite : une grosse diffusion ne peut pas ouvrir un nombre illimité de sockets
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=100),
+        timeout=5.0,
+    )
+
+    yield
+
+    # Les tâches de fond sont arrêtées avant toute sauvegarde finale ; une sauvegarde périodique
+    # en cours est menée à son terme pour ne jamais écrire en même temps que celles de l'arrêt
+    flush_stop.set()
+    for task in periodic_tasks:
+        task.cancel()
+    await asyncio.gather(flush_task, *periodic_tasks, return_exceptions=True)
+    # save_resume_data consomme lui-même ses alertes
+    loop.remove_reader(alert_read_fd)
+    await app.state.http.aclose()
+    # Écritures disque et attente des alertes libtorrent : bloquant, les trois sauvegardes
+    # sont indépendantes et s'exécutent en parallèle dans le pool de threads
+    await asyncio.gather(
+        asyncio.to_thread(save_session_state),
+        asyncio.to_thread(save_resume_data),
+        asyncio.to_thread(save_torrents_data),
+    )
+    print("Session state saved.")
+    with db_lock:
+        db_conn.close()
+
+app = FastAPI(title="BitTorrent Manager", default_response_class=MsgspecJSONResponse, lifespan=lifespan)
 
 # Endpoints API pour la gestion des torrents
-@app.post("/add-torrents/")
-async def add_torrents(files: List[UploadFile] = File(...)):
-    results = {"success": [], "errors": []}
-    for file in files:
+def read_file_sha1(file_path):
+    # Empreinte du fichier brut, sans aucun décodage bencode
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return hashlib.sha1(buf, usedforsecurity=False).hexdigest()
+
+def persist_and_add_upload(file):
+    # Écriture disque, décodage et ajout libtorrent : bloquant, exécuté dans un thread
+    upload_fd, upload_path = tempfile.mkstemp(suffix=".part", dir=torrent_files_dir)
+    # mkstemp crée le fichier en 0600 : les .torrent conservés restent lisibles comme avant
+    os.fchmod(upload_fd, 0o644)
+    try:
         try:
-            contents = await file.read()
-            info = lt.torrent_info(lt.bdecode(contents))
-            info_hash = str(info.info_hash())
-
-            if info_hash in torrents:
-                results["errors"].append({"filename": file.filename, "error": "Torrent already added."})
-                continue
+            stream_upload_to_fd(file, upload_fd)
+        finally:
+            os.close(upload_fd)
+        # Un renvoi à l'identique est reconnu sur l'empreinte du fichier seule
+        file_sha1 = read_file_sha1(upload_path)
+        if file_sha1 in known_file_sha1:
+            return {"filename": file.filename, "error": "Torrent already added."}
+
+        # libtorrent lit et décode le fichier lui-même, sans copie en bytes Python
+        info = lt.torrent_info(upload_path)
+        info_hash = str(info.info_hash())
+
+        with torrents_lock:
+            if info_hash in torrents or info_hash in pending_restores or info_hash in pending_uploads:
+                return {"filename": file.filename, "error": "Torrent already added."}
+            # Réservé : un envoi concurrent du même torrent est écarté pendant l'ajout, fait hors du verrou
+            pending_uploads.add(info_hash)
 
+        try:
             torrent_file_path = os.path.join(torrent_files_dir, f"{info_hash}.torrent")
-            with open(torrent_file_path, 'wb') as torrent_file:
-                torrent_file.write(contents)
+            os.replace(upload_path, torrent_file_path)
+
+            # Réutilise le torrent_info déjà construit plutôt que de relire le fichier
+            add_torrent(info, info_hash, name=info.name(), file_sha1=file_sha1)
+        finally:
+            with torrents_lock:
+                pending_uploads.discard(info_hash)
+        return {"filename": file.filename, "info_hash": info_hash}
+    except Exception as e:
+        return {"filename": file.filename, "error": str(e)}
+    finally:
+        # Supprime le fichier temporaire s'il n'a pas été renommé
+        try:
+            os.remove(upload_path)
+        except FileNotFoundError:
+            pass
+
+def record_added_torrents(info_hashes):
+    # Une seule transaction pour tous les torrents d'un envoi ; ceux retirés entre-temps sont ignorés
+    with torrents_lock:
+        recs = [
+            TorrentRec(
+                info_hash=info_hash,
+                name=torrents[info_hash]['name'],
+                total_uploaded=0,
+                total_downloaded=0,
+                file_sha1=torrents[info_hash]['file_sha1'],
+            ) for info_hash in info_hashes if info_hash in torrents
+        ]
+        queue_db_upsert(recs)
+        persisted_recs.update((rec.info_hash, rec) for rec in recs)
+    flush_db_writes()
 
-            add_torrent_from_file(torrent_file_path, info_hash)
-            results["success"].append({"filename": file.filename, "info_hash": info_hash})
-        except Exception as e:
-            results["errors"].append({"filename": file.filename, "error": str(e)})
+@app.post("/add-torrents/")
+async def add_torrents(files: List[UploadFile] = File(...)):
+    results = {"success": [], "errors": []}
+    # Les envois sont traités en parallèle dans le pool de threads
+    outcomes = await asyncio.gather(*[asyncio.to_thread(persist_and_add_upload, file) for file in files])
+    for outcome in outcomes:
+        results["errors" if "error" in outcome else "success"].append(outcome)
+    if results["success"]:
+        await asyncio.to_thread(record_added_torrents, [outcome["info_hash"] for outcome in results["success"]])
     return results
 
 @app.get("/torrents/")
-async def list_torrents():
-    torrents_list = []
-    for info_hash, torrent in torrents.items():
-        handle = torrent['handle']
-        status = handle.status()
-        ratio = (torrent['total_uploaded'] / torrent['total_downloaded']) if torrent['total_downloaded'] > 0 else 0
-        formatted_ratio = f"{ratio:.6f}"
-        torrents_list.append({
-            "info_hash": info_hash,
-            "name": status.name,
-            "progress": status.progress * 100,
-            "download_rate": status.download_rate / 1000,
-            "upload_rate": status.upload_rate / 1000,
-            "status": str(status.state),
-            "seedtime_hours": status.seeding_time / 3600,
-            "num_peers": status.num_peers,
-            "ratio": formatted_ratio
-        })
-    return torrents_list
-
-
-@app.post("/remove-torrents/")
-async def remove_torrents(request: TorrentRemovalRequest):
+async def list_torrents(raw: bool = False):
+    # Les lignes sont construites au fil des alertes : la requête ne fait que les rassembler
+    with torrents_lock:
+        return list((raw_torrent_rows if raw else torrent_rows).values())
+
+
+def torrent_file_paths(info_hash):
+    return [os.path.join(torrent_files_dir, f"{info_hash}.{extension}") for extension in ("torrent", "resume")]
+
+def unlink_torrent_files(info_hashes):
+    # Tâche de fond après la réponse : supprime les .torrent et .resume des torrents retirés.
+    # Verrou pris torrent par torrent : la boucle d'événements n'attend jamais tout le lot
+    for info_hash in info_hashes:
+        with torrents_lock:
+            if info_hash in torrents or info_hash in pending_restores or info_hash in pending_uploads:
+                # Ré-ajouté entre-temps : ses fichiers sont de nouveau utilisés
+                continue
+            for torrent_file_path in torrent_file_paths(info_hash):
+                try:
+                    os.remove(torrent_file_path)
+                except FileNotFoundError:
+                    pass
+
+def remove_torrents_batch(info_hashes, remove_files):
+    # Retrait libtorrent et suppression des fichiers de tout le lot : bloquant, exécuté dans un thread
     removed = []
     not_found = []
-    files_removed = []
-
-    for info_hash in request.info_hashes:
-        if info_hash in torrents:
-            handle = torrents[info_hash]
-            session.remove_torrent(handle, request.remove_files)
-            del torrents[info_hash]
-
-            torrent_file_path = os.path.join(torrent_files_dir, f"{info_hash}.torrent")
-            if os.path.exists(torrent_file_path):
-                os.remove(torrent_file_path)
-                files_removed.append(torrent_file_path)
-
+    handles = []
+    remove_flags = lt.session.delete_files if remove_files else 0
+    with torrents_lock:
+        for info_hash in info_hashes:
+            torrent = torrents.pop(info_hash, None)
+            torrent_status_cache.pop(info_hash, None)
+            torrent_rows.pop(info_hash, None)
+            raw_torrent_rows.pop(info_hash, None)
+            # Un torrent encore en restauration sera retiré de la session à son add_torrent_alert
+            pending = pending_restores.pop(info_hash, None)
+            persisted_recs.pop(info_hash, None)
+            if torrent is None and pending is None:
+                not_found.append(info_hash)
+                continue
+            known_file_sha1.discard(torrent['file_sha1'] if torrent is not None else pending.file_sha1)
             removed.append(info_hash)
-        else:
-            not_found.append(info_hash)
+            if torrent is not None:
+                handles.append(torrent['handle'])
+            else:
+                pending_removals[info_hash] = remove_flags
+        queue_db_delete(removed)
+    flush_db_writes()
+
+    for handle in handles:
+        session.remove_torrent(handle, remove_flags)
+    # Fichiers dont la suppression est programmée après la réponse ; conservés si le torrent est ré-ajouté d'ici là
+    files_removed = [path for info_hash in removed for path in torrent_file_paths(info_hash) if os.path.exists(path)]
+    return removed, not_found, files_removed
+
+@app.post("/remove-torrents/")
+async def remove_torrents(request: TorrentRemovalRequest, background_tasks: BackgroundTasks):
+    # Tout le lot est traité en un seul passage dans le pool de threads
+    removed, not_found, files_removed = await asyncio.to_thread(
+        remove_torrents_batch, request.info_hashes, request.remove_files
+    )
 
     if not removed:
         raise HTTPException(status_code=404, detail="Torrents not found.")
 
+    # La suppression des fichiers n'allonge pas la réponse
+    background_tasks.add_task(unlink_torrent_files, removed)
+
     return {"message": "Torrents removal process completed.", "removed": removed, "not_found": not_found, "files_removed": files_removed}
 
 # Informations système
+def compute_system_info():
+    # Un seul appel par fonction psutil : chaque appel relit /proc
+    disk_usage = psutil.disk_usage('/')
+    memory = psutil.virtual_memory()
+    sizes = (disk_usage.total, disk_usage.used, disk_usage.free, memory.total, memory.available, memory.used, memory.free)
+    info = dict(zip(SYSINFO_GB_KEYS, (format_gb(size / GB) for size in sizes)))
+    info["disk_percent_used"] = f"{disk_usage.percent}%"
+    info["cpu_usage_percent"] = psutil.cpu_percent()
+    info["memory_percent_used"] = f"{memory.percent}%"
+    # Encodé une fois par instantané plutôt qu'à chaque requête
+    return msgspec.json.encode(info)
+
 @app.get("/system-info/")
 async def system_info():
-    disk_usage = psutil.disk_usage('/')
-    return {
-        "disk_total_gb": f"{disk_usage.total / (1024**3):.2f} Go",
-        "disk_used_gb": f"{disk_usage.used / (1024**3):.2f} Go",
-        "disk_free_gb": f"{disk_usage.free / (1024**3):.2f} Go",
-        "disk_percent_used": f"{disk_usage.percent}%",
-        "cpu_usage_percent": psutil.cpu_percent(),
-        "memory_total_gb": f"{psutil.virtual_memory().total / (1024**3):.2f} Go",
-        "memory_available_gb": f"{psutil.virtual_memory().available / (1024**3):.2f} Go",
-        "memory_used_gb": f"{psutil.virtual_memory().used / (1024**3):.2f} Go",
-        "memory_free_gb": f"{psutil.virtual_memory().free / (1024**3):.2f} Go",
-        "memory_percent_used": f"{psutil.virtual_memory().percent}%"
-    }
+    # L'instantané est tenu à jour par sample_system_info : aucun appel psutil dans la requête
+    return Response(content=system_info_cache["data"], media_type="application/json")
 
 # Enregistrement et déclenchement de webhooks
 @app.post("/register-webhook/")
-async def register_webhook(webhook: Webhook):
-    webhooks.append(webhook)
+async def register_webhook(webhook: Webhook, format: Literal["msgpack", "json"] = "msgpack"):
+    # Les charges utiles sont envoyées en msgpack, sauf si l'abonné demande du JSON
+    subscribers = webhooks_by_event[webhook.event]
+    if webhook.url in subscribers:
+        raise HTTPException(status_code=409, detail="Webhook already registered.")
+    subscribers[webhook.url] = format
     return {"message": "Webhook registered successfully."}
 
 async def trigger_webhooks(event: str, data: dict, background_tasks: BackgroundTasks):
-    for webhook in webhooks:
-        if webhook.event == event:
-            background_tasks.add_task(send_webhook, webhook.url, data)
-
-async def send_webhook(url: str, data: dict):
+    # Seuls les abonnés de l'événement sont parcourus
+    targets = webhooks_by_event.get(event)
+    if targets:
+        background_tasks.add_task(fan_out_webhooks, list(targets.items()), data)
+
+def encode_webhook_payload(data: dict, format: str):
+    if format == "json":
+        # Même encodeur C que les réponses de l'API
+        return msgspec.json.encode(data), "application/json"
+    return webhook_encoder.encode(data), "application/msgpack"
+
+async def fan_out_webhooks(targets: List[Tuple[str, str]], data: dict):
+    # Chaque format demandé n'est encodé qu'une fois par événement
+    payloads = {format: encode_webhook_payload(data, format) for _, format in targets}
+    # Tous les webhooks d'un événement partent en parallèle ; un échec inattendu n'interrompt pas les autres
+    results = await asyncio.gather(*[send_webhook(url, *payloads[format]) for url, format in targets], return_exceptions=True)
+    for (url, _), result in zip(targets, results):
+        if isinstance(result, Exception):
+            print(f"Failed to send webhook to {url}: {result}")
+
+async def send_webhook(url: str, content: bytes, content_type: str):
     try:
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json=data)
+        await app.state.http.post(url, content=content, headers={"content-type": content_type})
     except httpx.RequestError as e:
         print(f"Failed to send webhook: {e}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file
+    # Un seul worker : la session libtorrent et son état vivent dans ce processus
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info", loop="uvloop", http="httptools")
\ No newline at end of file